@@ -1,8 +1,14 @@
 import streamlit as st
 import google.generativeai as genai
-from tavily import TavilyClient
+import requests
 import json
-from PIL import Image
+import orjson
+import base64
+import asyncio
+import hashlib
+import typing
+import pandas as pd
+from PIL import Image, ImageOps, ExifTags
 import io
 
 # --- Page Configuration ---
@@ -17,53 +23,521 @@ st.set_page_config(
 try:
     GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
     TAVILY_API_KEY = st.secrets["TAVILY_API_KEY"]
-    genai.configure(api_key=GEMINI_API_KEY)
-    tavily = TavilyClient(api_key=TAVILY_API_KEY)
 except (FileNotFoundError, KeyError):
     st.error("API keys not found in secrets. Please check your .streamlit/secrets.toml file.", icon="⚠️")
     st.stop()
 
 
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+
+
+@st.cache_resource
+def get_tavily_session():
+    """
+    Returns a keep-alive HTTP session for the Tavily API, shared across reruns and sessions.
+    TavilyClient opens a fresh connection per search, so every call would repeat the TCP+TLS handshake.
+    """
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {TAVILY_API_KEY}", "Content-Type": "application/json"})
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=20))
+    return session
+
+
 # --- Tool Definition ---
-def perform_web_search(query: str):
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_tavily_search(query: str) -> str:
+    """
+    Runs a Tavily search and returns the results as a JSON string, memoized per query.
+    """
+    print(f"Performing search for: {query}")
+    response = get_tavily_session().post(TAVILY_SEARCH_URL, json={"query": query, "search_depth": "basic"},
+                                         timeout=60)
+    response.raise_for_status()
+    results = response.json()
+    if not results['results']:
+        return "[]"
+    return orjson.dumps([{"url": obj["url"], "content": obj["content"]} for obj in results['results']]).decode()
+
+
+def search_one(query: str):
     """
-    Performs a web search to find nutritional information for specific food items.
+    Performs a single web search, returning an error message instead of raising.
     """
     try:
-        print(f"Performing search for: {query}")
-        results = tavily.search(query=query, search_depth="basic")
-        return json.dumps([{"url": obj["url"], "content": obj["content"]} for obj in results['results']])
+        return _cached_tavily_search(query)
     except Exception as e:
         print(f"Error during search: {e}")
         return f"Error performing search: {e}"
 
 
+async def perform_web_search(queries: list[str]):
+    """
+    Performs web searches to find nutritional information for specific food items.
+    All queries are sent to Tavily concurrently and the results are keyed by query.
+    """
+    unique_queries = list(dict.fromkeys(str(query) for query in queries))
+    results = await asyncio.gather(*[asyncio.to_thread(search_one, query) for query in unique_queries])
+    return dict(zip(unique_queries, results))
+
+
+# --- System Constitution (WITH EXPLICIT FALLBACK RULE) ---
+NUTRI_AI_CONSTITUTION = """
+// SYSTEM CONSTITUTION: Nutri-AI v3.5
+
+// 1. CORE IDENTITY: You are "Nutri-AI," an expert visual nutritional estimator.
+// 2. PRIMARY DIRECTIVE: ESTIMATE FIRST. Always make your own visual estimate of quantity first and state it clearly.
+// 3. RULE OF INQUIRY: Ask for simple confirmations. For composite items (shakes, stews), you must ask for ingredients. If you hit a dead end, try asking a more open-ended question.
+
+// 4. RULE OF TOOL USE (WITH FALLBACK):
+// 4a. If the user mentions a specific brand or restaurant, use the `perform_web_search` tool to find specific data. When you need several facts (e.g., calories AND weight), send all queries in ONE `perform_web_search` call.
+// 4b. If the user corrects your findings, try to perform a new search with the more specific information.
+// 4c. NEW - FALLBACK RULE: If the web search fails to find specific nutritional data for a brand/restaurant, you MUST inform the user that you couldn't find specific info, and then IMMEDIATELY provide an estimate based on your general knowledge of that food type (e.g., "I couldn't find the exact details for that restaurant's biryani, but a typical plate of chicken biryani has about...").
+
+// 5. CONVERSATIONAL BOUNDARY: Your role is ONLY to gather information. DO NOT provide calorie counts or final calculations in the chat.
+// 6. ENDING THE CONVERSATION: When the user indicates they are finished or asks for the results, instruct them to use the button.
+// 7. EXECUTION DIRECTIVE: Your very first response MUST NOT repeat any rules. Start DIRECTLY with your visual analysis.
+"""
+
+INITIAL_PROMPT = "Here is a photo of my meal."
+
+
 # --- Model and Tool Initialization ---
-my_search_tool = genai.protos.Tool(
-    function_declarations=[
-        genai.protos.FunctionDeclaration(
-            name='perform_web_search',
-            description="Performs a web search using the Tavily API to find nutritional information for specific food items, especially branded or restaurant items. Use this to find calorie counts, macronutrient breakdowns (protein, carbs, fat), and average weights or serving sizes. For example: 'calories in Burger King Whopper' or 'average weight of a Walmart Great Value chicken breast'.",
-            parameters=genai.protos.Schema(
-                type=genai.protos.Type.OBJECT,
-                properties={
-                    'query': genai.protos.Schema(type=genai.protos.Type.STRING,
-                                                 description="The precise search query string.")
-                },
-                required=['query']
+@st.cache_resource
+def get_search_tool():
+    """
+    Builds the function declaration for `perform_web_search` once per process.
+    """
+    return genai.protos.Tool(
+        function_declarations=[
+            genai.protos.FunctionDeclaration(
+                name='perform_web_search',
+                description="Performs web searches using the Tavily API to find nutritional information for specific food items, especially branded or restaurant items. Use this to find calorie counts, macronutrient breakdowns (protein, carbs, fat), and average weights or serving sizes. Pass every query you need in a single call; they are searched in parallel. For example: ['calories in Burger King Whopper', 'average weight of a Burger King Whopper'].",
+                parameters=genai.protos.Schema(
+                    type=genai.protos.Type.OBJECT,
+                    properties={
+                        'queries': genai.protos.Schema(type=genai.protos.Type.ARRAY,
+                                                       items=genai.protos.Schema(type=genai.protos.Type.STRING),
+                                                       description="The precise search query strings.")
+                    },
+                    required=['queries']
+                )
             )
-        )
-    ]
-)
+        ]
+    )
+
 
 available_tools = {
     "perform_web_search": perform_web_search,
 }
 
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-pro-latest",
-    tools=[my_search_tool]
-)
+
+def get_function_calls(response):
+    """
+    Returns every function call the model requested in a response.
+    """
+    return [part.function_call for part in response.candidates[0].content.parts if part.function_call]
+
+
+async def run_tool_calls(function_calls):
+    """
+    Executes the requested tools concurrently and returns their function responses as parts.
+    A failing tool answers with its error text so every function call still gets a response.
+    """
+    async def run_tool(function_call):
+        try:
+            tool_args = dict(function_call.args)
+            tool_response = await available_tools[function_call.name](**tool_args)
+        except Exception as e:
+            print(f"Error during tool call {function_call.name}: {e}")
+            tool_response = f"Error calling {function_call.name}: {e}"
+        return genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(
+                name=function_call.name,
+                response={"content": tool_response},
+            )
+        )
+
+    return await asyncio.gather(*[run_tool(function_call) for function_call in function_calls])
+
+
+def stream_response(response, placeholder):
+    """
+    Renders a streamed model response into a placeholder as its text chunks arrive.
+    The SDK aggregates the chunks into the response object, so the caller can read its function calls afterwards.
+    The placeholder is shared across a turn, so text streamed before a tool call is overwritten by the next reply.
+    Raises ValueError if the model stopped for any reason other than STOP or MAX_TOKENS.
+    """
+    text = ""
+    for chunk in response:
+        for part in chunk.parts:
+            if part.text:
+                text += part.text
+                placeholder.markdown(text)
+    finish_reason = genai.protos.Candidate.FinishReason(response.candidates[0].finish_reason)
+    if finish_reason not in (genai.protos.Candidate.FinishReason.STOP, genai.protos.Candidate.FinishReason.MAX_TOKENS):
+        raise ValueError(f"The response ended early ({finish_reason.name}).")
+    return response
+
+
+@st.cache_resource
+def configure_genai():
+    """
+    Configures the Gemini SDK once per process.
+    """
+    genai.configure(api_key=GEMINI_API_KEY)
+
+
+def build_agent_model(model_name: str):
+    """
+    Builds a tool-enabled Nutri-AI model.
+    The constitution is set once as the system instruction instead of being sent as a chat message.
+    """
+    configure_genai()
+    return genai.GenerativeModel(
+        model_name=model_name,
+        tools=[get_search_tool()],
+        system_instruction=NUTRI_AI_CONSTITUTION
+    )
+
+
+@st.cache_resource
+def get_vision_model():
+    """
+    Returns the Pro model used for the initial visual analysis, shared across reruns.
+    """
+    return build_agent_model("gemini-1.5-pro-latest")
+
+
+@st.cache_resource
+def get_chat_model():
+    """
+    Returns the faster Flash model used for the information-gathering refinement turns, shared across reruns.
+    """
+    return build_agent_model("gemini-1.5-flash")
+
+
+@st.cache_resource
+def get_summarizer_model():
+    """
+    Returns the lightweight model used to compact older conversation turns.
+    """
+    configure_genai()
+    return genai.GenerativeModel(model_name="gemini-1.5-flash")
+
+
+class BreakdownItem(typing.TypedDict):
+    item: str
+    calories: int
+    protein_grams: int
+    carbs_grams: int
+    fat_grams: int
+
+
+class Breakdown(typing.TypedDict):
+    breakdown: list[BreakdownItem]
+
+
+NUTRIENT_COLUMNS = ["calories", "protein_grams", "carbs_grams", "fat_grams"]
+
+
+@st.cache_resource
+def get_finalizer_model():
+    """
+    Returns the model that produces the final breakdown, constrained to the Breakdown JSON schema.
+    """
+    configure_genai()
+    return genai.GenerativeModel(
+        model_name="gemini-1.5-flash",
+        generation_config={"response_mime_type": "application/json", "response_schema": Breakdown}
+    )
+
+
+# --- Image Preprocessing ---
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 85
+
+
+def downscale_image(image_data: bytes, mime_type: str) -> tuple[bytes, str]:
+    """
+    Shrinks an uploaded image to MAX_IMAGE_SIDE on its longest side and re-encodes it as JPEG.
+    The EXIF orientation is applied to the pixels first, since re-encoding drops the tag.
+    Images that already fit and need no rotation are returned untouched so they aren't re-encoded.
+    Returns the image bytes together with their MIME type.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    if max(image.size) <= MAX_IMAGE_SIDE and orientation == 1:
+        return image_data, mime_type
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+
+# --- Vision Analysis Cache ---
+def serialize_part(part):
+    """
+    Converts a content part into a plain dict, keeping inline image data so the image stays in context.
+    Returns None for parts with nothing to replay, such as empty text.
+    """
+    if part.inline_data.data:
+        return {"inline_data": {"mime_type": part.inline_data.mime_type, "data": part.inline_data.data}}
+    if part.function_call:
+        return {"function_call": type(part.function_call).to_dict(part.function_call)}
+    if part.function_response:
+        return {"function_response": type(part.function_response).to_dict(part.function_response)}
+    if part.text:
+        return {"text": part.text}
+    return None
+
+
+def serialize_history(history):
+    """
+    Converts chat history into plain dicts that st.cache_data can store and start_chat can reload.
+    """
+    serialized = []
+    for content in history:
+        parts = [serialized_part for serialized_part in map(serialize_part, content.parts) if serialized_part]
+        if parts:
+            serialized.append({"role": content.role, "parts": parts})
+    return serialized
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def initial_vision_turn(image_hash: str, _image_data: bytes, mime_type: str, prompt: str) -> list[dict]:
+    """
+    Runs the first visual analysis of an image and returns the serialized history.
+    Memoized on the image's SHA-256 so re-uploading the same photo skips the Gemini call.
+    The encoded bytes are sent as an inline blob, so they are never decoded and re-encoded.
+    """
+    image_part = genai.protos.Part(inline_data=genai.protos.Blob(mime_type=mime_type, data=_image_data))
+    chat_session = get_vision_model().start_chat()
+    response = chat_session.send_message([prompt, image_part])
+    # Finish any tool calls here so the cached history never ends on an unanswered function call.
+    function_calls = get_function_calls(response)
+    while function_calls:
+        response = chat_session.send_message(asyncio.run(run_tool_calls(function_calls)))
+        function_calls = get_function_calls(response)
+    return serialize_history(chat_session.history)
+
+
+# --- Conversation Memory ---
+def visible_messages(history):
+    """
+    Extracts the (role, text) pairs worth rendering from chat history.
+    Called once per turn, so reruns can render the transcript without re-filtering it.
+    """
+    messages = []
+    for content in history:
+        text = "".join(part.text for part in content.parts)
+        if content.role in ["user", "model"] and text.strip():
+            messages.append((content.role, text))
+    return messages
+
+
+ROLE_LABELS = {"user": "🧑 You", "model": "🧠 Nutri-AI"}
+
+
+def format_transcript(messages):
+    """
+    Joins rendered messages into one Markdown block with a role heading per message,
+    so earlier turns go over the websocket as a single element instead of one per message.
+    """
+    return "\n\n---\n\n".join(f"**{ROLE_LABELS[role]}**\n\n{text}" for role, text in messages)
+
+
+HISTORY_WINDOW = 8
+# Compact only once the history has grown well past the window, so the summarizer runs once every few turns.
+COMPACTION_TRIGGER = 2 * HISTORY_WINDOW
+SUMMARY_PREFIX = "Summary of our earlier conversation:"
+SUMMARY_PROMPT = """
+Summarize the following conversation between a user and a nutrition assistant about a meal.
+Keep every fact needed to estimate its nutrition: food items, ingredients, brands, preparation methods, quantities, and any numbers found in web searches.
+Respond with the summary only.
+
+"""
+
+
+def history_to_text(history):
+    """
+    Flattens chat history into a plain-text transcript for the summarizer. Image parts are skipped.
+    """
+    lines = []
+    for content in history:
+        for part in content.parts:
+            if part.text:
+                lines.append(f"{content.role}: {part.text}")
+            elif part.function_call:
+                lines.append(f"{content.role} called {part.function_call.name}: "
+                             f"{type(part.function_call).to_dict(part.function_call)['args']}")
+            elif part.function_response:
+                lines.append(f"{part.function_response.name} returned: "
+                             f"{type(part.function_response).to_dict(part.function_response)['response']}")
+    return "\n".join(lines)
+
+
+def compact_history(chat_session):
+    """
+    Once the history exceeds COMPACTION_TRIGGER messages, cuts the model context back to the photo turn
+    plus roughly the last HISTORY_WINDOW messages. Older turns are summarized with a small model and
+    folded into the photo turn, so the image stays in context.
+    """
+    history = chat_session.history
+    if len(history) <= COMPACTION_TRIGGER + 1:
+        return
+    # The kept window must open on a model turn so roles still alternate and tool call/response pairs stay intact.
+    cut = next((i for i in range(len(history) - HISTORY_WINDOW, len(history)) if history[i].role == "model"), None)
+    if cut is None or cut <= 1:
+        return
+
+    first_turn = history[0]
+    try:
+        summary = get_summarizer_model().generate_content(SUMMARY_PROMPT + history_to_text(history[:cut])).text
+    except Exception as e:
+        print(f"Error during history compaction: {e}")
+        return
+    kept_parts = [part for part in first_turn.parts if not part.text.startswith(SUMMARY_PREFIX)]
+    summary_part = genai.protos.Part(text=f"{SUMMARY_PREFIX}\n{summary}")
+    chat_session.history = [genai.protos.Content(role="user", parts=kept_parts + [summary_part])] + history[cut:]
+
+
+def finalizer_contents(history, final_prompt):
+    """
+    Builds the finalizer request: the meal photo, the conversation as a transcript, and the final prompt.
+    Tool calls are flattened to text because the finalizer model declares no tools.
+    """
+    image_parts = [part for part in history[0].parts if part.inline_data.data]
+    text_parts = [genai.protos.Part(text=history_to_text(history)), genai.protos.Part(text=final_prompt)]
+    return [genai.protos.Content(role="user", parts=image_parts + text_parts)]
+
+
+# --- Bulk Analysis (Batch Mode) ---
+BATCH_MODEL = "gemini-1.5-flash"
+BATCH_PROMPT = """
+You are "Nutri-AI," an expert visual nutritional estimator. This is a non-interactive bulk analysis, so you cannot ask questions.
+Identify each food item in the photo, estimate its quantity visually, and give a per-item and total breakdown of calories, protein, carbs, and fat.
+State the assumptions you made (portion sizes, cooking oil, etc.) briefly.
+"""
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+@st.cache_resource
+def get_batch_client():
+    """
+    Returns the google-genai client used for Batch Mode jobs, shared across reruns.
+    The SDK is imported here so cold starts that never touch Batch Mode don't pay for it.
+    """
+    from google import genai as google_genai
+    return google_genai.Client(api_key=GEMINI_API_KEY)
+
+
+def build_batch_jsonl(images):
+    """
+    Builds the Batch Mode JSONL payload, one downscaled image request per line keyed "img_<i>".
+    """
+    lines = []
+    for i, (image_data, mime_type) in enumerate(images):
+        image_data, mime_type = downscale_image(image_data, mime_type)
+        request = {"contents": [{"role": "user", "parts": [
+            {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(image_data).decode()}},
+            {"text": BATCH_PROMPT},
+        ]}]}
+        lines.append(json.dumps({"key": f"img_{i}", "request": request}))
+    return "\n".join(lines).encode()
+
+
+def submit_batch(uploaded_files):
+    """
+    Uploads the batch JSONL and starts a Batch Mode job, returning the created job.
+    """
+    from google.genai import types as genai_types
+    client = get_batch_client()
+    images = [(uploaded_file.getvalue(), uploaded_file.type) for uploaded_file in uploaded_files]
+    batch_file = client.files.upload(
+        file=io.BytesIO(build_batch_jsonl(images)),
+        config=genai_types.UploadFileConfig(display_name="bulk-meal-analysis", mime_type="jsonl")
+    )
+    batch_job = client.batches.create(model=BATCH_MODEL, src=batch_file.name,
+                                      config={"display_name": "bulk-meal-analysis"})
+    return batch_job
+
+
+def load_batch_results(batch_job):
+    """
+    Downloads a finished job's output file and returns the model text (or error) per request key.
+    """
+    results = {}
+    output = get_batch_client().files.download(file=batch_job.dest.file_name).decode()
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        try:
+            results[entry["key"]] = entry["response"]["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError):
+            results[entry["key"]] = f"Error: {entry.get('error', 'no response returned')}"
+    return results
+
+
+def render_bulk_sidebar():
+    with st.sidebar:
+        st.header("Bulk Analyze 📦")
+        st.caption("Submit many meal photos as one Batch Mode job: half the cost, results within 24 hours.")
+        bulk_files = st.file_uploader("Upload meal photos...", type=["jpg", "jpeg", "png"],
+                                      accept_multiple_files=True, key="bulk_files")
+        if bulk_files and st.button("Submit Batch"):
+            with st.spinner("Submitting batch job..."):
+                try:
+                    batch_job = submit_batch(bulk_files)
+                except Exception as e:
+                    st.error(f"Could not submit the batch job. Error: {e}", icon="⚠️")
+                else:
+                    st.session_state.batch_job_name = batch_job.name
+                    st.session_state.batch_state = batch_job.state.name
+                    st.session_state.batch_file_names = {f"img_{i}": f.name for i, f in enumerate(bulk_files)}
+                    st.session_state.batch_results = None
+
+        batch_job_name = st.session_state.get("batch_job_name")
+        if not batch_job_name:
+            return
+        state = st.session_state.batch_state
+        # Poll only on request; a batches.get round trip on every rerun would slow down every chat turn.
+        if state not in BATCH_DONE_STATES and st.button("🔄 Check Status"):
+            try:
+                batch_job = get_batch_client().batches.get(name=batch_job_name)
+                if batch_job.state.name == "JOB_STATE_SUCCEEDED":
+                    st.session_state.batch_results = load_batch_results(batch_job)
+                st.session_state.batch_state = state = batch_job.state.name
+            except Exception as e:
+                st.warning(f"Could not check the batch job. Error: {e}", icon="⚠️")
+
+        if state == "JOB_STATE_SUCCEEDED":
+            file_names = st.session_state.get("batch_file_names", {})
+            for key, text in st.session_state.batch_results.items():
+                with st.expander(file_names.get(key, key)):
+                    st.markdown(text)
+        elif state in BATCH_DONE_STATES:
+            st.error(f"Batch job ended with state {state}.", icon="⚠️")
+        else:
+            st.info(f"Batch job is {state}. Check back later.", icon="⏳")
+
+
+def parse_final_analysis(raw_text: str):
+    """
+    Parses the finalizer's JSON. Schema-constrained output parses directly with orjson; if the model
+    wrapped it in prose anyway, the first JSON object is decoded in place without slicing the text.
+    """
+    try:
+        data = orjson.loads(raw_text)
+    except orjson.JSONDecodeError:
+        json_start = raw_text.find('{')
+        if json_start == -1:
+            raise ValueError("No valid JSON object found in the AI's response.")
+        data, _ = json.JSONDecoder().raw_decode(raw_text, json_start)
+    if not isinstance(data, dict):
+        raise ValueError("The AI's response is not a JSON object.")
+    return data
 
 
 def load_css():
@@ -73,87 +547,91 @@ def load_css():
 def main():
     load_css()
     st.title("Intelligent AI Calorie Estimator 🧠")
+    render_bulk_sidebar()
 
     if "analysis_stage" not in st.session_state:
         st.session_state.analysis_stage = "upload"
     if "uploaded_image_data" not in st.session_state:
         st.session_state.uploaded_image_data = None
+    if "uploaded_image_type" not in st.session_state:
+        st.session_state.uploaded_image_type = None
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "chat_session" not in st.session_state:
+        st.session_state.chat_session = None
 
+    # Each stage below falls through to the next one in the same run instead of a full st.rerun().
+    # Stage UIs live in st.empty() slots that are cleared on the way out, so no stale widgets stay on screen.
     if st.session_state.analysis_stage == "upload":
-        st.info("Upload a food photo. The AI will act as your expert estimator.", icon="🧑‍🔬")
-        uploaded_file = st.file_uploader("Upload an image of your meal...", type=["jpg", "jpeg", "png"])
+        upload_area = st.empty()
+        with upload_area.container():
+            st.info("Upload a food photo. The AI will act as your expert estimator.", icon="🧑‍🔬")
+            uploaded_file = st.file_uploader("Upload an image of your meal...", type=["jpg", "jpeg", "png"])
         if uploaded_file:
-            st.session_state.uploaded_image_data = uploaded_file.getvalue()
+            st.session_state.uploaded_image_data, st.session_state.uploaded_image_type = downscale_image(
+                uploaded_file.getvalue(), uploaded_file.type)
             st.session_state.analysis_stage = "analyzing"
-            st.rerun()
+            upload_area.empty()
 
     if st.session_state.analysis_stage == "analyzing":
-        st.image(st.session_state.uploaded_image_data, caption="Your meal.", use_container_width=True)
-        if st.button("🔍 Analyze Food"):
-            with st.spinner("Performing expert analysis..."):
-                # --- FINAL PROMPT WITH EXPLICIT FALLBACK RULE ---
-                prompt = """
-                // SYSTEM CONSTITUTION: Nutri-AI v3.5
-
-                // 1. CORE IDENTITY: You are "Nutri-AI," an expert visual nutritional estimator.
-                // 2. PRIMARY DIRECTIVE: ESTIMATE FIRST. Always make your own visual estimate of quantity first and state it clearly.
-                // 3. RULE OF INQUIRY: Ask for simple confirmations. For composite items (shakes, stews), you must ask for ingredients. If you hit a dead end, try asking a more open-ended question.
-
-                // 4. RULE OF TOOL USE (WITH FALLBACK):
-                // 4a. If the user mentions a specific brand or restaurant, use the `perform_web_search` tool to find specific data.
-                // 4b. If the user corrects your findings, try to perform a new search with the more specific information.
-                // 4c. NEW - FALLBACK RULE: If the web search fails to find specific nutritional data for a brand/restaurant, you MUST inform the user that you couldn't find specific info, and then IMMEDIATELY provide an estimate based on your general knowledge of that food type (e.g., "I couldn't find the exact details for that restaurant's biryani, but a typical plate of chicken biryani has about...").
-
-                // 5. CONVERSATIONAL BOUNDARY: Your role is ONLY to gather information. DO NOT provide calorie counts or final calculations in the chat.
-                // 6. ENDING THE CONVERSATION: When the user indicates they are finished or asks for the results, instruct them to use the button.
-                // 7. EXECUTION DIRECTIVE: Your very first response MUST NOT repeat any rules. Start DIRECTLY with your visual analysis.
-                """
-                image_file = Image.open(io.BytesIO(st.session_state.uploaded_image_data))
-                chat_session = model.start_chat()
-                response = chat_session.send_message([prompt, image_file])
-                st.session_state.messages = chat_session.history
-                st.session_state.analysis_stage = "conversation"
-                st.rerun()
+        analyze_area = st.empty()
+        with analyze_area.container():
+            st.image(st.session_state.uploaded_image_data, caption="Your meal.", use_container_width=True)
+            if st.button("🔍 Analyze Food"):
+                with st.spinner("Performing expert analysis..."):
+                    image_data = st.session_state.uploaded_image_data
+                    image_hash = hashlib.sha256(image_data).hexdigest()
+                    image_type = st.session_state.uploaded_image_type
+                    # The Pro model's first turn is handed over to the Flash chat model for the refinement turns.
+                    chat_session = get_chat_model().start_chat(
+                        history=initial_vision_turn(image_hash, image_data, image_type, INITIAL_PROMPT))
+                    st.session_state.chat_session = chat_session
+                    # Skip the opening photo turn so the transcript starts with the model's analysis.
+                    st.session_state.messages = visible_messages(chat_session.history[1:])
+                    st.session_state.analysis_stage = "conversation"
+        if st.session_state.analysis_stage == "conversation":
+            analyze_area.empty()
 
     if st.session_state.analysis_stage == "conversation":
         st.subheader("Refine Details with the AI", divider='rainbow')
-        chat_session = model.start_chat(history=st.session_state.messages)
+        chat_session = st.session_state.chat_session
 
-        for message in chat_session.history:
-            if message.parts[0].text.strip().lower().startswith("// system"):
-                continue
-            if message.role in ["user", "model"]:
-                with st.chat_message(message.role):
-                    st.markdown(message.parts[0].text)
+        if st.session_state.messages:
+            *earlier_messages, (latest_role, latest_text) = st.session_state.messages
+            if earlier_messages:
+                with st.container(border=True):
+                    st.markdown(format_transcript(earlier_messages))
+            with st.chat_message(latest_role):
+                st.markdown(latest_text)
 
         if prompt := st.chat_input("Provide more details..."):
             with st.chat_message("user"):
                 st.markdown(prompt)
-            with st.spinner("Thinking..."):
-                response = chat_session.send_message(prompt)
-
-                while len(response.candidates[0].content.parts) > 0 and response.candidates[0].content.parts[
-                    0].function_call:
-                    function_call = response.candidates[0].content.parts[0].function_call
-                    tool_name = function_call.name
-                    if tool_name in available_tools:
-                        tool_args = dict(function_call.args)
-                        function_to_call = available_tools[tool_name]
-                        tool_response = function_to_call(**tool_args)
-
-                        response = chat_session.send_message(
-                            [genai.protos.Part(
-                                function_response=genai.protos.FunctionResponse(
-                                    name=tool_name,
-                                    response={"content": tool_response},
-                                )
-                            )]
-                        )
-                    else:
-                        break
-                st.session_state.messages = chat_session.history
+            history_before_turn = list(chat_session.history)
+            placeholder = None
+            try:
+                with st.chat_message("model"):
+                    placeholder = st.empty()
+                    with st.spinner("Thinking..."):
+                        response = stream_response(chat_session.send_message(prompt, stream=True), placeholder)
+                        function_calls = get_function_calls(response)
+
+                        while function_calls:
+                            tool_parts = asyncio.run(run_tool_calls(function_calls))
+                            response = stream_response(chat_session.send_message(tool_parts, stream=True),
+                                                       placeholder)
+                            function_calls = get_function_calls(response)
+                        st.session_state.messages.extend(
+                            visible_messages(chat_session.history[len(history_before_turn):]))
+                        compact_history(chat_session)
+            except Exception as e:
+                # A failed or blocked reply leaves the session unusable, so roll it back to before this turn.
+                chat_session.history = history_before_turn
+                if placeholder is not None:
+                    placeholder.empty()
+                st.error(f"The AI couldn't complete that reply, so it was discarded. Please try again. Error: {e}",
+                         icon="⚠️")
+            else:
                 st.rerun()
 
         if st.button("✅ All Details Provided, Calculate Final Estimate!"):
@@ -163,14 +641,14 @@ def main():
 
                 - **Synthesize All Information:** Use every piece of information from our conversation (ingredients, preparation methods, quantities, and any data from web searches) to inform your calculations.
                 - **Use Your Internal Knowledge:** For ingredients like "one large chicken breast," or if a web search failed, you must use your internal knowledge to estimate the nutritional values.
-                - **Output Format:** You MUST ONLY respond with a single, valid JSON object. Do not include any other text. The object must have a "breakdown" key containing a list of items. Each item must have keys for "item", "calories", "protein_grams", "carbs_grams", and "fat_grams".
                 - **Handle Uncertainty:** If, after using all your knowledge and tools, you are still truly unable to calculate a specific value, default that value to 0. But you must try to calculate first.
 
                 Example: `{"breakdown": [{"item": "Pan-fried Chicken Kebabs (1 large breast)","calories": 550,"protein_grams": 75,"carbs_grams": 5,"fat_grams": 25}]}`
 
                 Now, provide the final JSON response for the meal we discussed.
                 """
-                response = chat_session.send_message(final_prompt)
+                contents = finalizer_contents(chat_session.history, final_prompt)
+                response = get_finalizer_model().generate_content(contents)
                 st.session_state.final_analysis = response.text
                 st.session_state.analysis_stage = "results"
                 st.rerun()
@@ -179,55 +657,28 @@ def main():
         st.success("### Here is your detailed nutritional estimate:", icon="🎉")
         raw_text = st.session_state.get("final_analysis", "")
         try:
-            json_start = raw_text.find('{')
-            json_end = raw_text.rfind('}') + 1
-            if json_start == -1 or json_end == 0:
-                raise ValueError("No valid JSON object found in the AI's response.")
-            json_str = raw_text[json_start:json_end]
-            data = json.loads(json_str)
+            data = parse_final_analysis(raw_text)
             breakdown_list = data.get("breakdown", [])
             if not breakdown_list:
                 st.warning("The AI was unable to provide a breakdown. Please try again.")
 
-            total_calories, total_protein, total_carbs, total_fat = 0, 0, 0, 0
-            display_data = []
-
-            for item in breakdown_list:
-                try:
-                    calories = int(item.get("calories"))
-                except (ValueError, TypeError):
-                    calories = 0
-
-                try:
-                    protein = int(item.get("protein_grams"))
-                except (ValueError, TypeError):
-                    protein = 0
-
-                try:
-                    carbs = int(item.get("carbs_grams"))
-                except (ValueError, TypeError):
-                    carbs = 0
-
-                try:
-                    fat = int(item.get("fat_grams"))
-                except (ValueError, TypeError):
-                    fat = 0
-
-                total_calories += calories
-                total_protein += protein
-                total_carbs += carbs
-                total_fat += fat
-                display_data.append(
-                    {"Item": item.get("item", "N/A"), "Calories": f"{calories} kcal", "Protein": f"{protein}g",
-                     "Carbs": f"{carbs}g", "Fat": f"{fat}g"})
-
-            st.table(display_data)
+            df = pd.DataFrame(breakdown_list).reindex(columns=["item", *NUTRIENT_COLUMNS])
+            df[NUTRIENT_COLUMNS] = df[NUTRIENT_COLUMNS].apply(pd.to_numeric, errors="coerce").fillna(0).astype(int)
+            totals = df[NUTRIENT_COLUMNS].sum()
+
+            st.table(pd.DataFrame({
+                "Item": df["item"].fillna("N/A"),
+                "Calories": df["calories"].astype(str) + " kcal",
+                "Protein": df["protein_grams"].astype(str) + "g",
+                "Carbs": df["carbs_grams"].astype(str) + "g",
+                "Fat": df["fat_grams"].astype(str) + "g",
+            }))
             st.subheader("Calculated Totals", divider='rainbow')
             col1, col2, col3, col4 = st.columns(4)
-            col1.metric("Total Calories", f"{total_calories} kcal")
-            col2.metric("Total Protein", f"{total_protein}g")
-            col3.metric("Total Carbs", f"{total_carbs}g")
-            col4.metric("Total Fat", f"{total_fat}g")
+            col1.metric("Total Calories", f"{totals['calories']} kcal")
+            col2.metric("Total Protein", f"{totals['protein_grams']}g")
+            col3.metric("Total Carbs", f"{totals['carbs_grams']}g")
+            col4.metric("Total Fat", f"{totals['fat_grams']}g")
 
         except (ValueError, json.JSONDecodeError) as e:
             st.error(f"Could not parse the final analysis. Error: {e}", icon="🤷")
@@ -236,7 +687,8 @@ def main():
 
         if st.button("Start Over"):
             for key in list(st.session_state.keys()):
-                del st.session_state[key]
+                if not key.startswith("batch_"):
+                    del st.session_state[key]
             st.rerun()
 
 if __name__ == "__main__":